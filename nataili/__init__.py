@@ -6,6 +6,9 @@ enable_local_ray_temp = Switch()
 disable_progress = Switch()
 disable_download_progress = Switch()
 enable_ray_alternative = Switch()
+disable_gpu_preprocess = Switch()
+enable_torch_compile = Switch()
+enable_int8_embeds = Switch()
 
 
 class InvalidModelException(Exception):
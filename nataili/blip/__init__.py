@@ -1 +1,9 @@
-from .caption import Caption
+from nataili.util.lazy import lazy_getattr
+
+_LAZY = {
+    "Caption": ".caption",
+}
+
+__all__ = list(_LAZY)
+
+__getattr__ = lazy_getattr(__name__, _LAZY)
@@ -1 +1 @@
-from .cache import Cache, get_cache_directory, get_package
+from .cache import Cache, get_cache_directory, get_package, hash_file, hash_pil_image
@@ -20,6 +20,8 @@ import json
 import os
 import sqlite3
 import sys
+import threading
+import weakref
 from pathlib import Path
 
 from PIL import Image
@@ -50,6 +52,76 @@ def get_cache_directory():
     return os.path.join(base_dir, "nataili")
 
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path):
+    """
+    :param file_path: Path to the file
+    :return: SHA256 hash of the file, read in chunks
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def hash_pil_image(pil_image: Image.Image):
+    """
+    :param pil_image: PIL image
+    :return: SHA256 hash of the raw pixel data, identical to hashlib.sha256(pil_image.tobytes()).hexdigest()
+    The pixel data is fed to the hash as the raw encoder produces it,
+    so the full H*W*C buffer is never joined into a single bytes object.
+    """
+    pil_image.load()
+    image_hash = hashlib.sha256()
+    if pil_image.width == 0 or pil_image.height == 0:
+        return image_hash.hexdigest()
+    encoder = Image._getencoder(pil_image.mode, "raw", pil_image.mode)
+    encoder.setimage(pil_image.im, (0, 0) + pil_image.size)
+    bufsize = max(HASH_CHUNK_SIZE, pil_image.width * 4)
+    while True:
+        _, errcode, data = encoder.encode(bufsize)
+        image_hash.update(data)
+        if errcode:
+            break
+    if errcode < 0:
+        raise RuntimeError(f"encoder error {errcode} while hashing image")
+    return image_hash.hexdigest()
+
+
+def _write_rows(conn, rows):
+    """
+    :param conn: sqlite3 connection of the cache
+    :param rows: List of queued (file, hash, pil_hash) rows, emptied once they are written
+    """
+    if not rows:
+        return
+    conn.executemany("INSERT INTO cache VALUES (?, ?, ?)", rows)
+    conn.commit()
+    rows.clear()
+
+
+def _flush_rows(rows, lock, cache_db):
+    """
+    Writes the rows still queued when a Cache is garbage collected or the interpreter exits.
+    Only holds the rows, not the Cache, so the Cache itself can be collected.
+    Opens its own connection as the Cache's one can only be used by the thread which created the Cache.
+    """
+    try:
+        with lock:
+            if not rows:
+                return
+            conn = sqlite3.connect(cache_db)
+            try:
+                _write_rows(conn, rows)
+            finally:
+                conn.close()
+    except sqlite3.Error as e:
+        logger.error(f"Could not write queued rows to {cache_db}: {e}")
+
+
 class Cache:
     def __init__(self, cache_name, cache_subname=None, cache_parentname=None):
         """
@@ -85,6 +157,9 @@ class Cache:
         self.conn = sqlite3.connect(self.cache_db)
         self.cursor = self.conn.cursor()
         self.create_sqlite_db()
+        self.pending_lock = threading.Lock()
+        self.pending_rows = []
+        weakref.finalize(self, _flush_rows, self.pending_rows, self.pending_lock, self.cache_db)
 
     def list_dir(self, input_directory, extensions=[".webp"]):
         """
@@ -104,10 +179,12 @@ class Cache:
         Get all entries from the cache
         :return: List of all entries
         """
+        self.flush()
         self.cursor.execute("SELECT file FROM cache")
         return [x[0] for x in self.cursor.fetchall()]
 
     def get_all_export(self):
+        self.flush()
         self.cursor.execute("SELECT file, pil_hash FROM cache")
         return {x[0]: x[1] for x in self.cursor.fetchall()}
 
@@ -132,8 +209,7 @@ class Cache:
         :param file_path: Path to the file
         :return: Hash of the file
         """
-        with open(file_path, "rb") as f:
-            return hashlib.sha256(f.read()).hexdigest()
+        return hash_file(file_path)
 
     def hash_pil_image(self, pil_image: Image.Image):
         """
@@ -141,7 +217,7 @@ class Cache:
         :param pil_image: PIL image
         :return: Hash of the PIL image
         """
-        return hashlib.sha256(pil_image.tobytes()).hexdigest()
+        return hash_pil_image(pil_image)
 
     def hash_pil_image_file(self, file_path):
         """
@@ -188,6 +264,28 @@ class Cache:
         if commit:
             self.conn.commit()
 
+    def queue_sqlite_row(self, file: str, hash: str, pil_hash: str, every: int = 32):
+        """
+        Queue a row for the sqlite database, rows are written in one transaction once every rows are queued
+        :param every: Number of queued rows after which they are written
+        Queued rows are found by get() before they are written. They are written by flush(), before get_all(),
+        get_all_export(), filter_list() and key_exists() read the database, and when the Cache is collected or at exit
+        """
+        with self.pending_lock:
+            self.pending_rows.append((file, hash, pil_hash))
+            if len(self.pending_rows) >= every:
+                self._write_pending()
+
+    def flush(self):
+        """
+        Write all rows queued with queue_sqlite_row()
+        """
+        with self.pending_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        _write_rows(self.conn, self.pending_rows)
+
     def populate_sqlite_db(self, list_of_files: list):
         """
         Populate the sqlite database from the cache
@@ -201,6 +299,7 @@ class Cache:
         """
         Check if a key exists in the cache
         """
+        self.flush()
         query = "SELECT hash, pil_hash FROM cache WHERE file=?"
         self.cursor.execute(query, (key,))
         if self.cursor.fetchone():
@@ -231,6 +330,16 @@ class Cache:
 
         self.cursor.execute(query, tuple(values))
         result = self.cursor.fetchone()
+        if not result:
+            with self.pending_lock:
+                for pending_file, pending_hash, pending_pil_hash in self.pending_rows:
+                    if (
+                        (file and pending_file and os.path.splitext(pending_file)[0] == file)
+                        or (file_hash and pending_hash == file_hash)
+                        or (pil_hash and pending_pil_hash == pil_hash)
+                    ):
+                        result = (pending_hash, pending_pil_hash)
+                        break
         if result:
             if no_return:
                 return True
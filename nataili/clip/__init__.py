@@ -1,4 +1,12 @@
-from .coca import CoCa
-from .image import ImageEmbed
-from .interrogate import Interrogator
-from .text import TextEmbed
+from nataili.util.lazy import lazy_getattr
+
+_LAZY = {
+    "CoCa": ".coca",
+    "ImageEmbed": ".image",
+    "Interrogator": ".interrogate",
+    "TextEmbed": ".text",
+}
+
+__all__ = list(_LAZY)
+
+__getattr__ = lazy_getattr(__name__, _LAZY)
@@ -25,7 +25,7 @@ from PIL import Image
 from tqdm import tqdm
 
 from nataili import disable_progress
-from nataili.cache import Cache
+from nataili.cache import Cache, hash_pil_image
 from nataili.clip.image import ImageEmbed
 from nataili.model_manager.clip import ClipModelManager
 from nataili.util.logger import logger
@@ -58,7 +58,7 @@ class BulkImageEmbedder:
 
     def insert(self, image, input_directory):
         pil_image = Image.open(f"{input_directory}/{image}.webp").convert("RGB")
-        pil_hash = hashlib.sha256(pil_image.tobytes()).hexdigest()
+        pil_hash = hash_pil_image(pil_image)
         # hash = hashlib.sha256(open(f"{input_directory}/{image}.webp", "rb").read()).hexdigest()
         self.cache_image.add_sqlite_row(file=image, pil_hash=pil_hash, hash=None)
 
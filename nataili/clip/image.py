@@ -15,23 +15,40 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import hashlib
 import os
 
 # threading
 import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
-from uuid import uuid4
+from functools import lru_cache
+from typing import List
 
 import numpy as np
+import PIL
 import torch
+import torchvision.transforms as T
+import torchvision.transforms.functional as TF
 from PIL import Image
 
-from nataili.cache import Cache
+from nataili import disable_gpu_preprocess
+from nataili.cache import Cache, hash_file, hash_pil_image
 from nataili.util.cast import autocast_cuda
 from nataili.util.logger import logger
 
+# Number of images preprocessed on the device at once, each holds a full resolution float copy on the device
+DEVICE_PREPROCESS_SLOTS = 4
+
+
+@lru_cache(maxsize=None)
+def warn_cpu_preprocess():
+    """
+    Warns once if images are preprocessed on the CPU without pillow-simd.
+    pillow-simd versions are suffixed with .postN
+    """
+    if "post" not in PIL.__version__:
+        logger.warning("Preprocessing images on the CPU. Install pillow-simd for faster preprocessing")
+
 
 class ImageEmbed:
     def __init__(self, model, cache: Cache):
@@ -42,21 +59,83 @@ class ImageEmbed:
         self.model = model
         self.cache = cache
         self.executor = ThreadPoolExecutor(max_workers=1024, thread_name_prefix="SaveThread")
+        self.preprocess_executor = ThreadPoolExecutor(
+            max_workers=os.cpu_count(), thread_name_prefix="PreprocessThread"
+        )
+        self.device_preprocess_slots = threading.BoundedSemaphore(DEVICE_PREPROCESS_SLOTS)
+        self.device_preprocess_steps = None
+        if torch.device(self.model["device"]).type == "cuda" and not disable_gpu_preprocess.active:
+            self.device_preprocess_steps = self._device_preprocess_steps()
+        if self.device_preprocess_steps is None:
+            warn_cpu_preprocess()
+
+    def _device_preprocess_steps(self):
+        """
+        Translates model["preprocess"] into steps which can run on a tensor on the model's device.
+        Returns None if the pipeline contains a transform which can not be translated.
+        """
+        steps = []
+        for transform in getattr(self.model["preprocess"], "transforms", [None]):
+            if isinstance(transform, T.Resize):
+                steps.append(("resize", transform))
+            elif isinstance(transform, T.CenterCrop):
+                steps.append(("center_crop", transform))
+            elif isinstance(transform, T.ToTensor):
+                steps.append(("to_tensor", transform))
+            elif isinstance(transform, T.Normalize):
+                steps.append(("normalize", transform))
+            elif callable(transform) and "rgb" in getattr(transform, "__name__", "").lower():
+                # images are converted to RGB before being moved to the device
+                continue
+            else:
+                logger.debug(f"Can not preprocess on device, unsupported transform {transform}")
+                return None
+        return steps
+
+    def _preprocess_on_device(self, pil_image: Image.Image, steps):
+        """
+        :param pil_image: PIL image to preprocess
+        :param steps: Steps from _device_preprocess_steps()
+        Runs the model's preprocess pipeline on the model's device instead of on the CPU with PIL.
+        Returns the preprocessed image of shape (1, 3, height, width)
+        """
+        image = torch.from_numpy(np.array(pil_image.convert("RGB"))).to(self.model["device"])
+        image = image.permute(2, 0, 1).float() / 255
+        for step, transform in steps:
+            if step == "resize":
+                image = TF.resize(image, transform.size, transform.interpolation, transform.max_size, antialias=True)
+            elif step == "center_crop":
+                image = TF.center_crop(image, transform.size)
+            elif step == "to_tensor":
+                # match the clamping and 8 bit rounding PIL applies when resizing
+                image = (image.clamp(0, 1) * 255).round() / 255
+            elif step == "normalize":
+                image = TF.normalize(image, transform.mean, transform.std)
+        return image.unsqueeze(0)
+
+    def _preprocess(self, pil_image: Image.Image):
+        """
+        :param pil_image: PIL image to preprocess
+        Preprocesses on the model's device when possible, otherwise with model["preprocess"] on the CPU.
+        Returns the preprocessed image of shape (1, 3, height, width) on the model's device
+        """
+        if self.device_preprocess_steps is not None:
+            with self.device_preprocess_slots:
+                return self._preprocess_on_device(pil_image, self.device_preprocess_steps)
+        return self.model["preprocess"](pil_image).unsqueeze(0).to(self.model["device"])
 
     @autocast_cuda
     def _batch(self, pil_images: list):
         # logger.info(pil_images)
         for pil_image in pil_images:
             # logger.info(pil_image)
-            pil_image["hash"] = hashlib.sha256(pil_image["pil_image"].tobytes()).hexdigest()
+            pil_image["hash"] = hash_pil_image(pil_image["pil_image"])
         preprocess_images = []
         to_remove = []
         with torch.no_grad():
             for pil_image in pil_images:
                 try:
-                    preprocess_images.append(
-                        self.model["preprocess"](pil_image["pil_image"]).unsqueeze(0).to(self.model["device"])
-                    )
+                    preprocess_images.append(self._preprocess(pil_image["pil_image"]))
                 except RuntimeError as e:
                     logger.error(e)
                     logger.error(pil_image)
@@ -71,23 +150,65 @@ class ImageEmbed:
             image_features = self.model["model"].encode_image(preprocess_images)
             for image_embed_array, pil_image in zip(image_features, pil_images):
                 future = self.executor.submit(self._save, image_embed_array, pil_image["hash"])
-                self.cache.add_sqlite_row(
+                self.cache.queue_sqlite_row(
                     file=pil_image["filename"].replace(".webp", ""), pil_hash=pil_image["hash"], hash=None
                 )
+            # the rows of a batch are written together, so callers can read them from the database right away
+            self.cache.flush()
+
+    @autocast_cuda
+    def embed_batch(self, images: List[Image.Image], batch_size: int = 32):
+        """
+        :param images: List of PIL images to embed, must not be empty
+        :param batch_size: Number of images preprocessed and passed to encode_image at once
+        Preprocesses the images in parallel and embeds them with one encode_image call per batch_size images.
+        The embeds are not saved to the cache.
+        Returns normalized image features of shape (len(images), embed_dim) on the model's device,
+        in the dtype encode_image produces them (float16 under autocast)
+        """
+        image_features = []
+        for start in range(0, len(images), batch_size):
+            preprocess_images = list(
+                self.preprocess_executor.map(self._preprocess, images[start : start + batch_size])
+            )
+            preprocess_images = torch.cat(preprocess_images, dim=0)
+            image_features.append(self.model["model"].encode_image(preprocess_images))
+            del preprocess_images
+        image_features = torch.cat(image_features, dim=0)
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+        return image_features
 
     def _save(self, image_embed_array, image_hash):
+        """
+        Writes to a temporary file first, embeds are reused by hash as soon as the file exists,
+        so a reader must never see a partly written one
+        """
         image_embed_array /= image_embed_array.norm(dim=-1, keepdim=True)
-        np.save(f"{self.cache.cache_dir}/{image_hash}", image_embed_array.float().cpu().detach().numpy())
+        filename = f"{self.cache.cache_dir}/{image_hash}.npy"
+        temp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_filename, "wb") as f:
+            np.save(f, image_embed_array.float().cpu().detach().numpy())
+        os.replace(temp_filename, filename)
 
     @autocast_cuda
     def __call__(
-        self, image: Image.Image = None, filename: str = None, directory: str = None, skip_cache: bool = False
+        self,
+        image: Image.Image = None,
+        filename: str = None,
+        directory: str = None,
+        skip_cache: bool = False,
+        return_features: bool = False,
     ):
         """
         :param pil_image: PIL image to embed
+        :param return_features: If True, also return the normalized image features on the model's device
+            Features are kept in the dtype encode_image produces them, they are only cast to float32 when saved
         SHA256 hash of image is used as key in cache
         If image is not in cache, embed it and save it to cache
-        Returns SHA256 hash of image
+        An embed file already named after the hash is reused even if the cache database has no row for it
+        Returns SHA256 hash of image, or a tuple of (SHA256 hash of image, image features) if return_features is True
+        When return_features is True the cache file is written in the background, so callers
+        must use the returned features rather than reading the cache file back.
         """
         if image is None and filename is None:
             raise ValueError("Either image or filename must be set")
@@ -97,23 +218,31 @@ class ImageEmbed:
             pil_image = Image.open(f"{directory}/{filename}").convert("RGB")
         else:
             pil_image = image
-        if image is None:
-            file_hash = hashlib.sha256(open(f"{directory}/{filename}", "rb").read()).hexdigest()
-            image_hash = hashlib.sha256(pil_image.tobytes()).hexdigest()
-        else:
-            file_hash = None
-            image_hash = hashlib.sha256(pil_image.tobytes()).hexdigest()
+        file_hash = hash_file(f"{directory}/{filename}") if image is None else None
+        image_hash = hash_pil_image(pil_image)
         if not skip_cache:
             cached = self.cache.get(pil_hash=image_hash)
+            if not cached and os.path.exists(f"{self.cache.cache_dir}/{image_hash}.npy"):
+                # Embeds are named by image hash, so one saved by another process or run can be reused as is
+                self.cache.queue_sqlite_row(file=filename, hash=file_hash, pil_hash=image_hash)
+                cached = f"{self.cache.cache_dir}/{image_hash}.npy"
             if cached:
                 logger.debug(f"Image {image_hash} already in cache")
+                if return_features:
+                    return image_hash, torch.from_numpy(np.load(cached)).float().to(self.model["device"])
                 return image_hash
         else:
             logger.debug(f"Skipping cache for image {image_hash}")
         logger.debug(f"Embedding image {image_hash}")
         with torch.no_grad():
-            preprocess_image = self.model["preprocess"](pil_image).unsqueeze(0).to(self.model["device"])
-        image_features = self.model["model"].encode_image(preprocess_image).float()
-        self._save(image_features, image_hash)
-        self.cache.add_sqlite_row(file=filename, hash=file_hash, pil_hash=image_hash)
+            preprocess_image = self._preprocess(pil_image)
+        image_features = self.model["model"].encode_image(preprocess_image)
+        if return_features:
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+            self.executor.submit(self._save, image_features.clone(), image_hash)
+        else:
+            self._save(image_features, image_hash)
+        self.cache.queue_sqlite_row(file=filename, hash=file_hash, pil_hash=image_hash)
+        if return_features:
+            return image_hash, image_features
         return image_hash
@@ -17,18 +17,30 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Union
 
 import numpy as np
 import torch
 from PIL import Image
 
+from nataili import enable_int8_embeds, enable_torch_compile
 from nataili.cache import Cache
 from nataili.clip.image import ImageEmbed
 from nataili.clip.text import TextEmbed
+from nataili.util.load_npy import load_npy
 from nataili.util.logger import logger
 
 
+def score(image_features, text_mat):
+    """
+    :param image_features: Image features of shape (number of images, embed_dim)
+    :param text_mat: Normalized and transposed text features from Interrogator.text_mat
+    :return: Softmax over the texts of the scaled similarity, of shape (number of images, len(texts))
+    """
+    return (100.0 * torch.matmul(image_features.to(text_mat.dtype), text_mat)).float().softmax(dim=-1)
+
+
 class Interrogator:
     def __init__(self, model):
         """
@@ -40,20 +52,68 @@ class Interrogator:
         self.model = model
         self.cache = Cache(self.model["cache_name"], cache_parentname="embeds", cache_subname="text")
         self.cache_image = Cache(self.model["cache_name"], cache_parentname="embeds", cache_subname="image")
+        # Shared across calls so its thread pools and preprocess steps are only set up once
+        self.image_embed = ImageEmbed(self.model, self.cache_image)
         self.embed_lists = {}
+        self.text_mat = {}
+        # Per-text embeds are read in parallel so open/read latency overlaps on slow filesystems
+        self.load_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="LoadThread")
+        # Only rank() uses the compiled score, it is called with one image so shapes are fixed per key and
+        # CUDA graphs are captured once per key. rank_batch() sees a different number of images on each call
+        # and would recompile each time, so it uses score as is.
+        self.rank_score = score
+        if enable_torch_compile.active and hasattr(torch, "compile"):
+            self.rank_score = torch.compile(score, mode="reduce-overhead", dynamic=False)
 
-    def load(self, key: str, text_array: List[str], individual: bool = True, device: str = "cuda"):
+    def _bulk_filename(self, text_hashes: List[str]):
         """
-        :param key: Key to use for embed_lists
-        :param text_array: List of text to embed
-        :param individual: Whether to store each text embed individually or as a concatenated tensor
-        If individual is True, self.embed_lists[key] will be a dict with text as key and embed as value.
-        If individual is False, self.embed_lists[key] will be a tensor of all text embeds concatenated.
+        :param text_hashes: SHA256 hashes of the texts, in order
+        :return: Path of the bulk file holding the embeds of all texts, in order
         """
-        logger.debug(f"key: {key}, text_array: {text_array}, individual: {individual}")
+        bulk_hash = hashlib.sha256("".join(text_hashes).encode("utf-8")).hexdigest()
+        if enable_int8_embeds.active:
+            return f"{self.cache.cache_dir}/bulk_int8_{bulk_hash}.npy"
+        return f"{self.cache.cache_dir}/bulk_{bulk_hash}.npy"
+
+    def _save_bulk(self, filename: str, arr: np.ndarray):
+        """
+        :param filename: Path to save the array to
+        :param arr: Array to save
+        Writes to a temporary file first so an interrupted save never leaves a truncated file behind
+        """
+        temp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(temp_filename, "wb") as f:
+            np.save(f, arr)
+        os.replace(temp_filename, filename)
+
+    def _read_bulk(self, bulk_filename: str):
+        """
+        :param bulk_filename: Path of the bulk file
+        :return: Tensor of the bulk embeds, int8 bulk files are dequantized with their per-row scale
+        """
+        text_features = torch.from_numpy(load_npy(bulk_filename))
+        if text_features.dtype == torch.int8:
+            scale = torch.from_numpy(np.load(bulk_filename.replace(".npy", ".scale.npy")))
+            text_features = text_features.float() * scale.float()
+        return text_features
+
+    def _load_text_features(self, key: str, text_array: List[str]):
+        """
+        :param key: Key to use for logging
+        :param text_array: List of text to load
+        :return: Tensor of shape (len(text_array), embed_dim) with the text embeds in text_array order
+        The embeds are read from a single float16 bulk file, see load_npy().
+        If enable_int8_embeds is active, the bulk file is int8 with a float16 per-row scale stored next to it.
+        If the bulk file does not exist, missing texts are embedded and the bulk file is
+        built from the individual text embeds in the cache.
+        """
+        text_hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in text_array]
+        bulk_filename = self._bulk_filename(text_hashes)
+        if os.path.exists(bulk_filename):
+            logger.debug(f"Loading {key} embeds from {bulk_filename}")
+            return self._read_bulk(bulk_filename)
         cached = True
-        for text in text_array:
-            text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        for text, text_hash in zip(text_array, text_hashes):
             if self.cache.get(file_hash=text_hash) is None:
                 cached = False
                 logger.debug(f"{text} not cached")
@@ -66,38 +126,55 @@ class Interrogator:
                 text_embed(text)
         else:
             logger.debug(f"{key} embeds already cached")
-        logger.debug(f"Loading {key} embeds")
+        logger.debug(f"Building {key} bulk embeds {bulk_filename}")
+        # Rows are written straight into a preallocated array, float32 is only kept when it still has to be quantized
+        dtype = np.float32 if enable_int8_embeds.active else np.float16
+        filenames = []
+        for text, text_hash in zip(text_array, text_hashes):
+            filename = f"{self.cache.cache_dir}/{text_hash}.npy"
+            logger.debug(f"text: {text}, text_hash: {text_hash}, filename: {filename}")
+            filenames.append(filename)
+        text_features = None
+        for i, row in enumerate(self.load_executor.map(lambda filename: np.load(filename).reshape(-1), filenames)):
+            if text_features is None:
+                text_features = np.empty((len(text_array), row.shape[0]), dtype=dtype)
+            text_features[i] = row
+        if enable_int8_embeds.active:
+            scale = np.abs(text_features).max(axis=-1, keepdims=True) / 127
+            scale[scale == 0] = 1
+            # The scale is saved first, the bulk file existing means both are complete
+            self._save_bulk(bulk_filename.replace(".npy", ".scale.npy"), scale.astype(np.float16))
+            text_features = np.round(text_features / scale).astype(np.int8)
+        self._save_bulk(bulk_filename, text_features)
+        return self._read_bulk(bulk_filename)
+
+    def load(self, key: str, text_array: List[str], individual: bool = True, device: str = "cuda"):
+        """
+        :param key: Key to use for embed_lists
+        :param text_array: List of text to embed
+        :param individual: Whether to store each text embed individually or as a concatenated tensor
+        If individual is True, self.embed_lists[key] will be a dict with text as key and embed as value,
+        and self.embed_lists[f"{key}_stacked"] will hold the same embeds stacked in text_array order.
+        If individual is False, self.text_mat[key] will be a tensor of all text embeds concatenated,
+        normalized and transposed to shape (embed_dim, len(text_array)), ready to be multiplied with image features.
+        It is float16 on CUDA devices and float32 otherwise.
+        """
+        logger.debug(f"key: {key}, text_array: {text_array}, individual: {individual}")
+        text_features = self._load_text_features(key, text_array).float().to(device)
         if individual:
-            self.embed_lists[key] = {}
-            for text in text_array:
-                text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
-                filename = f"{self.cache.cache_dir}/{text_hash}.npy"
-                logger.debug(f"text: {text}, text_hash: {text_hash}, filename: {filename}")
-                embed = torch.from_numpy(np.load(filename)).float().to(device)
-                if len(embed.shape) == 1:
-                    embed = embed.view(1, -1)
-                self.embed_lists[key][text] = embed
+            self.embed_lists[key] = {text: text_features[i].view(1, -1) for i, text in enumerate(text_array)}
+            self.embed_lists[f"{key}_stacked"] = text_features
         else:
-            with torch.no_grad():
-                text_features = []
-                for text in text_array:
-                    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
-                    filename = f"{self.cache.cache_dir}/{text_hash}.npy"
-                    logger.debug(f"text: {text}, text_hash: {text_hash}, filename: {filename}")
-                    embed = torch.from_numpy(np.load(filename)).float().to(device)
-                    if len(embed.shape) == 1:
-                        embed = embed.view(1, -1)
-                    text_features.append(embed)
-                text_features = torch.cat(text_features, dim=0)
             text_features /= text_features.norm(dim=-1, keepdim=True)
-            self.embed_lists[key] = text_features
+            dtype = torch.float16 if torch.device(device).type == "cuda" else torch.float32
+            self.text_mat[key] = text_features.T.contiguous().to(dtype)
 
     def _text_similarity(self, text_features, text_features_2):
         """
-        This is an internal function that calculates the similarity between two texts.
-        :param text_features: Text features to compare
-        :param text_features_2: Text features to compare to
-        :return: Similarity between text and text
+        This is an internal function that calculates the similarity between two sets of texts.
+        :param text_features: Stacked text features to compare
+        :param text_features_2: Stacked text features to compare to
+        :return: Similarity matrix of shape (len(text_features), len(text_features_2))
         """
         return text_features @ text_features_2.T
 
@@ -111,27 +188,26 @@ class Interrogator:
         :param device: Device to run on
         :return: dict of {text: {text: similarity}}
         """
-        if key not in self.embed_lists:
+        if f"{key}_stacked" not in self.embed_lists:
             self.load(key, text_array, individual=True, device=device)
-        if key_2 not in self.embed_lists:
+        if f"{key_2}_stacked" not in self.embed_lists:
             self.load(key_2, text_array_2, individual=True, device=device)
+        text_features = self.embed_lists[f"{key}_stacked"].to(device)
+        text_features_2 = self.embed_lists[f"{key_2}_stacked"].to(device)
+        similarities = self._text_similarity(text_features, text_features_2).cpu().tolist()
         similarity = {}
-        for text in text_array:
-            text_features = self.embed_lists[key][text].to(device)
-            similarity[text] = {}
-            for text_2 in text_array_2:
-                text_features_2 = self.embed_lists[key_2][text_2].to(device)
-                similarity[text][text_2] = round(self._text_similarity(text_features, text_features_2)[0][0].item(), 4)
+        for text, row in zip(text_array, similarities):
+            similarity[text] = {text_2: round(value, 4) for text_2, value in zip(text_array_2, row)}
         return similarity
 
-    def _similarity(self, image_features, text_features):
+    def _similarity(self, image_features, text_mat):
         """
-        This is an internal function that calculates the similarity between a single image and a single text.
+        This is an internal function that calculates the similarity between images and a set of texts.
         :param image_features: Image features to compare to text features
-        :param text_features: Text features to compare to image features
-        :return: Similarity between text and image
+        :param text_mat: Normalized and transposed text features from self.text_mat
+        :return: Similarity of each text to each image, of shape (len(image_features), len(texts))
         """
-        return text_features @ image_features.T
+        return torch.matmul(image_features.to(text_mat.dtype), text_mat)
 
     def similarity(self, image_features, text_array, key, device):
         """
@@ -142,15 +218,43 @@ class Interrogator:
         :param device: Device to run on
         :return: dict of {text: similarity}
         """
-        if key not in self.embed_lists:
+        return self.similarity_batch(image_features[:1], text_array, key, device)[0]
+
+    def similarity_batch(self, image_features, text_array, key, device):
+        """
+        For each image and each text in text_array, calculate the similarity between the image and the text.
+        :param image_features: Image features of shape (number of images, embed_dim)
+        :param text_array: List of text to compare to the images
+        :param key: Key to use for embed_lists
+        :param device: Device to run on
+        :return: List of dict of {text: similarity}, one per image
+        """
+        if key not in self.text_mat:
             logger.debug(f"Loading {key} embeds")
-            self.load(key, text_array, individual=True, device=device)
+            self.load(key, text_array, individual=False, device=device)
         logger.debug(f"{len(text_array)} text_array: {text_array}")
-        similarity = {}
-        for text in text_array:
-            text_features = self.embed_lists[key][text].to(device)
-            similarity[text] = round(self._similarity(image_features, text_features)[0][0].item(), 4)
-        return {k: v for k, v in sorted(similarity.items(), key=lambda item: item[1], reverse=True)}
+        similarities = self._similarity(image_features, self.text_mat[key]).cpu().tolist()
+        results = []
+        for row in similarities:
+            similarity = {text: round(value, 4) for text, value in zip(text_array, row)}
+            results.append({k: v for k, v in sorted(similarity.items(), key=lambda item: item[1], reverse=True)})
+        return results
+
+    def _top(self, probs, text_array, top_count):
+        """
+        This is an internal function that selects the most probable texts.
+        :param probs: Probabilities of shape (number of images, len(text_array))
+        :param text_array: List of text the probabilities refer to
+        :param top_count: Number of top results to return
+        :return: List of lists of {"text", "confidence"}, one list per row of probs
+        """
+        top_probs, top_labels = probs.cpu().topk(top_count, dim=-1)
+        top_probs = (top_probs * 100).numpy()
+        top_labels = top_labels.tolist()
+        return [
+            [{"text": text_array[label], "confidence": confidence} for label, confidence in zip(labels, confidences)]
+            for labels, confidences in zip(top_labels, top_probs)
+        ]
 
     def rank(self, image_features, text_array, key, device, top_count=2):
         """
@@ -167,21 +271,78 @@ class Interrogator:
         :return: List of tuples of (text, similarity)
         """
         top_count = min(top_count, len(text_array))
-        if key not in self.embed_lists:
+        if key not in self.text_mat:
             self.load(key, text_array, individual=False, device=device)
-        text_features = self.embed_lists[key].to(device)
 
-        similarity = torch.zeros((1, len(text_array))).to(device)
-        for i in range(image_features.shape[0]):
-            similarity += (100.0 * image_features[i].unsqueeze(0) @ text_features.T).softmax(dim=-1)
-        similarity /= image_features.shape[0]
+        # Softmax is taken per row of image_features, then averaged over the rows
+        similarity = self.rank_score(image_features, self.text_mat[key]).mean(dim=0, keepdim=True)
 
-        top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
-        top = [
-            {"text": text_array[top_labels[0][i].numpy()], "confidence": (top_probs[0][i].numpy() * 100)}
-            for i in range(top_count)
-        ]
-        return top
+        return self._top(similarity, text_array, top_count)[0]
+
+    def rank_batch(self, image_features, text_array, key, device, top_count=2):
+        """
+        Ranks the text_array by similarity to each image. See rank() for more details.
+        Unlike rank(), each row of image_features is ranked as a separate image.
+        :param image_features: Image features of shape (number of images, embed_dim)
+        :param text_array: List of text to compare to the images
+        :param key: Key to use for embed_lists.
+        :param device: Device to run on
+        :param top_count: Number of top results to return
+        :return: List of lists of {"text", "confidence"}, one list per image
+        """
+        top_count = min(top_count, len(text_array))
+        if key not in self.text_mat:
+            self.load(key, text_array, individual=False, device=device)
+        similarity = score(image_features, self.text_mat[key])
+        return self._top(similarity, text_array, top_count)
+
+    def batch(
+        self,
+        images: List[Image.Image],
+        text_array: Union[List[str], Dict[str, List[str]], None] = None,
+        similarity=False,
+        rank=False,
+        top_count=2,
+        batch_size=32,
+    ):
+        """
+        :param images: List of PIL images
+        :param text_array: List of text to compare to the images, or dict of lists of text to compare to the images
+        :param top_count: Number of top results to return
+        :param batch_size: Number of images embedded at once, lower it if the device runs out of memory
+        :return: List of results, one per image, in the same format as __call__()
+        Images are embedded batch_size at a time, then all of them are compared to each text list with one matmul.
+        Image embeds are kept on the device and are not saved to the image cache.
+        If text_array is None, uses default text_array from model["data_lists"]
+        """
+        if not similarity and not rank:
+            logger.error("Must specify similarity or rank")
+            return
+        if text_array is None:
+            text_array = self.model["data_lists"]
+        if isinstance(text_array, list):
+            text_array = {"default": text_array}
+        if not images:
+            return []
+        image_features = self.image_embed.embed_batch(images, batch_size=batch_size)
+        similarities = {}
+        ranks = {}
+        for k in text_array.keys():
+            if similarity:
+                similarities[k] = self.similarity_batch(image_features, text_array[k], k, self.model["device"])
+            if rank:
+                ranks[k] = self.rank_batch(image_features, text_array[k], k, self.model["device"], top_count)
+        results = []
+        for i in range(len(images)):
+            image_similarity = {k: v[i] for k, v in similarities.items()}
+            image_rank = {k: v[i] for k, v in ranks.items()}
+            if similarity and rank:
+                results.append({"similarity": image_similarity, "rank": image_rank})
+            elif similarity:
+                results.append(image_similarity)
+            else:
+                results.append(image_rank)
+        return results
 
     def __call__(
         self,
@@ -222,10 +383,7 @@ class Interrogator:
             text_array = {"default": text_array}
         elif isinstance(text_array, dict):
             pass
-        image_embed = ImageEmbed(self.model, self.cache_image)
-        image_hash = image_embed(image, filename, directory)
-        image_embed_array = np.load(f"{self.cache_image.cache_dir}/{image_hash}.npy")
-        image_features = torch.from_numpy(image_embed_array).float().to(self.model["device"])
+        image_hash, image_features = self.image_embed(image, filename, directory, return_features=True)
         if similarity and not rank:
             results = {}
             for k in text_array.keys():
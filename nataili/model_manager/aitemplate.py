@@ -52,7 +52,7 @@ class AITemplateModelManager(BaseModelManager):
             for aitemplate in self.models:
                 ait_files = self.get_aitemplate_files(sm)
                 if len(ait_files) > 0 and self.check_available(ait_files):
-                    self.available_models.append(aitemplate)
+                    self.available_models.add(aitemplate)
                     logger.info(f"Available AITemplate: {aitemplate}")
             if len(self.available_models) == 0:
                 logger.warning("No AITemplate available")
@@ -16,19 +16,26 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import hashlib
+import itertools
 import json
+import mmap
 import os
 import shutil
+import stat
 import sys
+import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from uuid import uuid4
 
 import git
 import requests
 import torch
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from transformers import logging
+from urllib3.util.retry import Retry
 
 from nataili import disable_download_progress
 from nataili.cache import get_cache_directory
@@ -41,12 +48,72 @@ else:
 
 logging.set_verbosity_error()
 
+HASH_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for the model reference before falling back to the local copy
+REFERENCE_TIMEOUT = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the requests.Session shared by all model managers.
+    Connections are pooled so each download and reference fetch does not pay for a new TCP and TLS handshake,
+    and requests answered with 502, 503 or 504 are retried.
+    Connection and read errors are not retried, so an offline machine falls back to local files right away.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=20,
+                max_retries=Retry(total=5, connect=0, read=0, backoff_factor=0.3, status_forcelist=(502, 503, 504)),
+            )
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def file_digest(file_name, algorithm):
+    """
+    :param file_name: Path of the file to hash
+    :param algorithm: Name of the hashlib algorithm, e.g. "md5" or "sha256"
+    Returns the hex digest of the file.
+    Uses hashlib.file_digest on Python 3.11+, which hashes in C without a Python loop per chunk.
+    On older Pythons the file is memory mapped and hashed with a single update, which releases the GIL,
+    falling back to reading HASH_CHUNK_SIZE blocks if the file can not be mapped.
+    """
+    with open(file_name, "rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, algorithm).hexdigest()
+        file_hash = hashlib.new(algorithm)
+        # empty files can not be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return file_hash.hexdigest()
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, OverflowError):
+            mapped = None
+        if mapped is not None:
+            with mapped:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                file_hash.update(mapped)
+            return file_hash.hexdigest()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+        return file_hash.hexdigest()
+
 
 class BaseModelManager:
     def __init__(self, download_reference=True):
         self.path = get_cache_directory()
         self.models = {}
-        self.available_models = []
+        self.available_models = set()
         self.loaded_models = {}
         self.tainted_models = []
         self.pkg = importlib_resources.files("nataili")
@@ -58,8 +125,14 @@ class BaseModelManager:
             f"https://raw.githubusercontent.com/db0/AI-Horde-image-model-reference/main/{self.models_db_name}.json"
         )
         self.download_reference = download_reference
+        self.session = get_session()
+        self.scan_dir_cache = {}
+        self.created_dirs = set()
+        self.pbar_position = threading.local()
 
     def init(self, list_models=False):
+        self.scan_dir_cache.clear()
+        self.created_dirs.clear()
         if self.download_reference:
             self.models = self.download_model_reference()
             logger.info(f"Downloaded model reference. Got {len(self.models)} models.")
@@ -69,20 +142,19 @@ class BaseModelManager:
         if list_models:
             for model in self.models:
                 logger.info(model)
-        models_available = []
-        for model in self.models:
-            if self.check_model_available(model):
-                models_available.append(model)
-        self.available_models = models_available
+        models = list(self.models)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            available = list(executor.map(self.check_model_available, models))
+        self.available_models = {model for model, is_available in zip(models, available) if is_available}
         logger.info(f"Got {len(self.available_models)} available models.")
         if list_models:
-            for model in self.available_models:
+            for model in self.get_available_models():
                 logger.info(model)
 
     def download_model_reference(self):
         try:
             logger.init("Model Reference", status="Downloading")
-            response = requests.get(self.remote_db)
+            response = self.session.get(self.remote_db, timeout=REFERENCE_TIMEOUT)
             logger.init_ok("Model Reference", status="OK")
             temp_models = response.json()
             models = {}
@@ -123,9 +195,9 @@ class BaseModelManager:
 
     def get_available_models(self):
         """
-        Returns the available models
+        Returns the available models, in the order of the model reference
         """
-        return self.available_models
+        return [model for model in self.models if model in self.available_models]
 
     def get_available_models_by_types(self, model_types=None):
         if not model_types:
@@ -182,14 +254,13 @@ class BaseModelManager:
         """
         Unloads all models
         """
-        for model in self.loaded_models:
-            del self.loaded_models[model]
+        self.loaded_models.clear()
         return True
 
     def taint_model(self, model_name):
         """Marks a model as not valid by remiving it from available_models"""
         if model_name in self.available_models:
-            self.available_models.remove(model_name)
+            self.available_models.discard(model_name)
             self.tainted_models.append(model_name)
 
     def taint_models(self, models):
@@ -206,93 +277,121 @@ class BaseModelManager:
         files = self.get_model_files(model_name)
         logger.debug(f"Validating {model_name} with {len(files)} files")
         logger.debug(files)
+        files = [file_details for file_details in files if ".yaml" not in file_details["path"]]
         for file_details in files:
-            if ".yaml" in file_details["path"]:
-                continue
             if not self.check_file_available(file_details["path"]):
                 logger.debug(f"File {file_details['path']} not found")
                 return False
-            if not skip_checksum and not self.validate_file(file_details):
-                logger.debug(f"File {file_details['path']} has invalid checksum")
-                return False
+        if skip_checksum or not files:
+            return True
+        # Hashing releases the GIL, so files are hashed concurrently
+        with ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+            futures = [executor.submit(self.validate_file, file_details) for file_details in files]
+            for file_details, future in zip(files, futures):
+                if not future.result():
+                    logger.debug(f"File {file_details['path']} has invalid checksum")
+                    for pending in futures:
+                        pending.cancel()
+                    return False
         return True
 
+    @staticmethod
+    def _stat_or_none(path):
+        """
+        :param path: Path to stat
+        Returns the os.stat_result of path, or None if it does not exist.
+        One stat call both checks existence and gives size and mtime.
+        """
+        try:
+            return os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    @staticmethod
+    def _mtime_of_file(path):
+        """
+        :param path: Path to stat
+        Returns the mtime of path if it is a regular file, None otherwise
+        """
+        file_stat = BaseModelManager._stat_or_none(path)
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            return None
+        return file_stat.st_mtime
+
+    @staticmethod
+    def _read_hash_file(hash_file, source_stat):
+        """
+        :param hash_file: Path of the .md5 or .sha256 file cached next to the source file
+        :param source_stat: os.stat_result of the source file
+        Returns the cached hash if the hash file is newer than the source file and was written for a file of
+        the same size, None otherwise. The size is kept on a "# size" comment line, which md5sum -c ignores.
+        """
+        hash_timestamp = BaseModelManager._mtime_of_file(hash_file) or 0
+        if hash_timestamp <= source_stat.st_mtime:
+            return None
+        with open(hash_file, "rt") as handle:
+            lines = handle.read().splitlines()
+        if not lines or f"# size {source_stat.st_size}" not in lines[1:]:
+            return None
+        return lines[0].split()[0]
+
+    @staticmethod
+    def _write_hash_file(hash_file, file_hash, source_stat):
+        """
+        :param hash_file: Path of the .md5 or .sha256 file cached next to the source file
+        :param file_hash: Hash of the source file
+        :param source_stat: os.stat_result of the source file
+        """
+        try:
+            with open(hash_file, "wt") as handle:
+                handle.write(f"{file_hash} *{os.path.basename(hash_file)}\n# size {source_stat.st_size}\n")
+        except (OSError, PermissionError):
+            logger.debug(f"Could not write to {hash_file}, ignoring")
+
     @staticmethod
     def get_file_md5sum_hash(file_name):
         # Bail out if the source file doesn't exist
-        if not os.path.isfile(file_name):
+        source_stat = BaseModelManager._stat_or_none(file_name)
+        if source_stat is None or not stat.S_ISREG(source_stat.st_mode):
             return
 
         # Check if we have a cached md5 hash for the source file
-        # and use that unless our source file is newer than our hash
+        # and use that unless our source file is newer than our hash or its size changed
         md5_file = f"{os.path.splitext(file_name)[0]}.md5"
-        source_timestamp = os.path.getmtime(file_name)
-        if os.path.isfile(md5_file):
-            hash_timestamp = os.path.getmtime(md5_file)
-        else:
-            hash_timestamp = 0
-        if hash_timestamp > source_timestamp:
+        md5_hash = BaseModelManager._read_hash_file(md5_file, source_stat)
+        if md5_hash:
             # Use our cached hash
-            with open(md5_file, "rt") as handle:
-                md5_hash = handle.read().split()[0]
             return md5_hash
 
         # Calculate the hash of the source file
-        with open(file_name, "rb") as file_to_check:
-            file_hash = hashlib.md5()
-            while True:
-                chunk = file_to_check.read(8192)  # Changed just because it broke pylint
-                if not chunk:
-                    break
-                file_hash.update(chunk)
-        md5_hash = file_hash.hexdigest()
+        md5_hash = file_digest(file_name, "md5")
 
         # Cache this md5 hash we just calculated. Use md5sum format files
         # so we can also use OS tools to manipulate these md5 files
-        try:
-            with open(md5_file, "wt") as handle:
-                handle.write(f"{md5_hash} *{os.path.basename(md5_file)}")
-        except (OSError, PermissionError):
-            logger.debug("Could not write to md5sum file, ignoring")
+        BaseModelManager._write_hash_file(md5_file, md5_hash, source_stat)
 
         return md5_hash
 
     @staticmethod
     def get_file_sha256_hash(file_name):
-        if not os.path.isfile(file_name):
+        source_stat = BaseModelManager._stat_or_none(file_name)
+        if source_stat is None or not stat.S_ISREG(source_stat.st_mode):
             raise FileNotFoundError("No file {}".format(file_name))
 
         # Check if we have a cached sha256 hash for the source file
-        # and use that unless our source file is newer than our hash
+        # and use that unless our source file is newer than our hash or its size changed
         sha256_file = f"{os.path.splitext(file_name)[0]}.sha256"
-        source_timestamp = os.path.getmtime(file_name)
-        if os.path.isfile(sha256_file):
-            hash_timestamp = os.path.getmtime(sha256_file)
-        else:
-            hash_timestamp = 0
-        if hash_timestamp > source_timestamp:
+        sha256_hash = BaseModelManager._read_hash_file(sha256_file, source_stat)
+        if sha256_hash:
             # Use our cached hash
-            with open(sha256_file, "rt") as handle:
-                sha256_hash = handle.read().split()[0]
             return sha256_hash
 
         # Calculate the hash of the source file
-        with open(file_name, "rb") as file_to_check:
-            file_hash = hashlib.sha256()
-            while True:
-                chunk = file_to_check.read(8192)
-                if not chunk:
-                    break
-                file_hash.update(chunk)
-        sha256_hash = file_hash.hexdigest()
+        sha256_hash = file_digest(file_name, "sha256")
 
         # Cache this sha256 hash we just calculated. Use sha256sum format files
         # so we can also use OS tools to manipulate these md5 files
-        try:
-            with open(sha256_file, "wt") as handle:
-                handle.write(f"{sha256_hash} *{os.path.basename(sha256_file)}")
-        except (OSError, PermissionError):
-            logger.debug("Could not write to sha256sum file, ignoring")
+        BaseModelManager._write_hash_file(sha256_file, sha256_hash, source_stat)
 
         return sha256_hash
 
@@ -300,6 +399,7 @@ class BaseModelManager:
         """
         :param file_details: A single file from the model's files list
         Checks if the file exists and if the checksum is correct
+        The file's "sha256sum" is checked if the model reference has one, otherwise its "md5sum"
         Returns True if the file is valid, False otherwise
         """
         full_path = f"{self.path}/{file_details['path']}"
@@ -336,9 +436,41 @@ class BaseModelManager:
         :param file_path: Path of the model's file. File is from the model's files list.
         Checks if the file exists
         Returns True if the file exists, False otherwise
+        Names are looked up in the cached listing of their directory. Symlinks found there are stat'ed so broken
+        ones do not count, and names not found are stat'ed as well, for case-insensitive filesystems.
         """
         full_path = f"{self.path}/{file_path}"
-        return os.path.exists(full_path)
+        directory, name = os.path.split(full_path)
+        is_symlink = self._scan_dir(directory).get(name) if name else None
+        if is_symlink is False:
+            return True
+        return self._stat_or_none(full_path) is not None
+
+    def _ensure_dir(self, directory):
+        """
+        :param directory: Full path of a directory
+        Creates the directory if needed, directories already created or seen since the last init() are skipped
+        """
+        if directory not in self.created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.created_dirs.add(directory)
+
+    def _scan_dir(self, directory):
+        """
+        :param directory: Full path of a directory
+        Returns a dict of the names of the entries in the directory to whether the entry is a symlink,
+        scanned once and cached in scan_dir_cache.
+        The cache is cleared by init() and when files are downloaded.
+        """
+        entries = self.scan_dir_cache.get(directory)
+        if entries is None:
+            if os.path.isdir(directory):
+                with os.scandir(directory) as it:
+                    entries = {entry.name: entry.is_symlink() for entry in it}
+            else:
+                entries = {}
+            self.scan_dir_cache[directory] = entries
+        return entries
 
     def check_available(self, files):
         """
@@ -361,28 +493,37 @@ class BaseModelManager:
         Downloads a file
         """
         full_path = f"{self.path}/{file_path}"
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        pbar_desc = full_path.split("/")[-1]
-        r = requests.get(url, stream=True, allow_redirects=True)
+        self._ensure_dir(os.path.dirname(full_path))
         with open(full_path, "wb") as f:
-            with tqdm(
-                # all optional kwargs
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-                miniters=1,
-                desc=pbar_desc,
-                total=int(r.headers.get("content-length", 0)),
-                disable=disable_download_progress.active,
-            ) as pbar:
-                for chunk in r.iter_content(chunk_size=16 * 1024):
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-
-    def download_model(self, model_name):
+            self.download_to(url, f, full_path.split("/")[-1])
+        self.scan_dir_cache.pop(os.path.dirname(full_path), None)
+
+    def download_to(self, url, f, pbar_desc):
+        """
+        :param url: URL of the file to download
+        :param f: Binary file object to write the download to
+        :param pbar_desc: Description of the progress bar
+        Streams a download into an open file
+        """
+        r = self.session.get(url, stream=True, allow_redirects=True)
+        # Read the raw stream in large blocks, still undoing any Content-Encoding like iter_content does
+        r.raw.decode_content = True
+        with tqdm.wrapattr(
+            f,
+            "write",
+            total=int(r.headers.get("content-length", 0)),
+            miniters=1,
+            desc=pbar_desc,
+            position=getattr(self.pbar_position, "value", None),
+            leave=getattr(self.pbar_position, "value", None) is None,
+            disable=disable_download_progress.active,
+        ) as pbar_f:
+            shutil.copyfileobj(r.raw, pbar_f, length=DOWNLOAD_CHUNK_SIZE)
+
+    def download_model(self, model_name, reinit=True):
         """
         :param model_name: Name of the model
+        :param reinit: If True, init() is called after a successful download to refresh the available models
         Checks if the model is available, downloads the model if it is not available.
         After download, validates the model.
         Returns True if the model is available, False otherwise.
@@ -422,56 +563,124 @@ class BaseModelManager:
                     f"Please place it in {download_path}/{download_name} then press ENTER to continue..."
                 )
                 input("")
+                self.scan_dir_cache.clear()
                 continue
             # TODO: simplify
             if "file_content" in download[i]:
                 file_content = download[i]["file_content"]
                 logger.info(f"writing {file_content} to {file_path}")
-                os.makedirs(os.path.join(self.path, download_path), exist_ok=True)
+                self._ensure_dir(os.path.join(self.path, download_path))
                 with open(os.path.join(self.path, os.path.join(download_path, download_name)), "w") as f:
                     f.write(file_content)
             elif "symlink" in download[i]:
                 logger.info(f"symlink {file_path} to {download[i]['symlink']}")
                 symlink = download[i]["symlink"]
-                os.makedirs(os.path.join(self.path, download_path), exist_ok=True)
+                self._ensure_dir(os.path.join(self.path, download_path))
                 os.symlink(symlink, os.path.join(self.path, os.path.join(download_path, download_name)))
             elif "git" in download[i]:
                 logger.info(f"git clone {download_url} to {file_path}")
-                os.makedirs(os.path.join(self.path, file_path), exist_ok=True)
+                self._ensure_dir(os.path.join(self.path, file_path))
                 git.Git(os.path.join(self.path, file_path)).clone(download_url)
             elif "unzip" in download[i]:
-                zip_path = f"{self.path}/{download_name}.zip"
-                temp_path = f"{self.path}/{str(uuid4())}/"
-                os.makedirs(temp_path, exist_ok=True)
-                self.download_file(download_url, zip_path)
-                logger.info(f"unzip {zip_path}")
-                with zipfile.ZipFile(zip_path, "r") as zip_ref:
-                    zip_ref.extractall(temp_path)
-                logger.info(f"moving {temp_path} to {download_path}")
-                shutil.move(temp_path, os.path.join(self.path, download_path))
-                logger.info(f"delete {zip_path}")
-                os.remove(zip_path)
-                logger.info(f"delete {temp_path}")
-                shutil.rmtree(temp_path)
+                extract_path = os.path.join(self.path, download_path)
+                self._ensure_dir(extract_path)
+                # The archive is never written next to the model, it is extracted straight into place
+                with tempfile.TemporaryFile(dir=self.path) as archive:
+                    self.download_to(download_url, archive, f"{download_name}.zip")
+                    archive.seek(0)
+                    logger.info(f"unzip {download_name}.zip to {extract_path}")
+                    with zipfile.ZipFile(archive, "r") as zip_ref:
+                        zip_ref.extractall(extract_path)
             else:
                 if not self.check_file_available(file_path) or model_name in self.tainted_models:
                     logger.debug(f"Downloading {download_url} to {file_path}")
                     self.download_file(download_url, file_path)
+        self.scan_dir_cache.clear()
         if not self.validate_model(model_name):
             return False
-        self.init()
+        if reinit:
+            self.init()
         return True
 
+    def _download_targets(self, model_name):
+        """
+        :param model_name: Name of the model
+        Returns the set of paths the model's download list writes to
+        """
+        download = self.get_model_download(model_name)
+        files = self.get_model_files(model_name)
+        targets = set()
+        for i, download_details in enumerate(download):
+            if "file_path" in download_details:
+                file_path = os.path.join(download_details["file_path"], download_details.get("file_name", ""))
+                targets.add(os.path.normpath(file_path))
+            elif i < len(files):
+                targets.add(os.path.normpath(files[i]["path"]))
+        return targets
+
+    def _group_by_download_targets(self, models):
+        """
+        :param models: List of model names
+        Returns the models grouped so that models writing to the same path are in the same group,
+        e.g. two controlnet models sharing one file. Models in a group keep the order of models.
+        """
+        groups = []
+        for model in models:
+            targets = self._download_targets(model)
+            group_models, group_targets = [model], set(targets)
+            for other in [group for group in groups if group[1] & targets]:
+                groups.remove(other)
+                group_models += other[0]
+                group_targets |= other[1]
+            groups.append((group_models, group_targets))
+        return [sorted(group_models, key=models.index) for group_models, _ in groups]
+
+    def _download_group(self, models):
+        """
+        :param models: Models sharing download targets, downloaded one after the other
+        """
+        for model in models:
+            logger.init(f"{model}", status="Downloading")
+            self.download_model(model, reinit=False)
+
     def download_all_models(self):
         """
         Downloads all models
+        Up to 4 models are downloaded at once over the shared session, init() is called once at the end.
+        Models which share a file are downloaded one after the other by the same worker,
+        models which need a manual download are handled first, one at a time.
         """
+        models = []
         for model in self.get_filtered_model_names(download_all=True):
             if not self.check_model_available(model):
-                logger.init(f"{model}", status="Downloading")
-                self.download_model(model)
+                models.append(model)
             else:
                 logger.info(f"{model} is already downloaded.")
+        if not models:
+            return True
+        manual = [model for model in models if any("manual" in d for d in self.get_model_download(model))]
+        self._download_group(manual)
+        groups = self._group_by_download_targets([model for model in models if model not in manual])
+        # Each worker draws its file progress bars on its own line below the overall bar
+        positions = itertools.count(1)
+
+        def set_pbar_position():
+            self.pbar_position.value = next(positions)
+
+        with ThreadPoolExecutor(max_workers=4, initializer=set_pbar_position) as executor:
+            with tqdm(
+                total=len(models),
+                initial=len(manual),
+                desc="Models",
+                unit="model",
+                position=0,
+                disable=disable_download_progress.active,
+            ) as pbar:
+                futures = {executor.submit(self._download_group, group): group for group in groups}
+                for future in as_completed(futures):
+                    future.result()
+                    pbar.update(len(futures[future]))
+        self.init()
         return True
 
     def check_model_available(self, model_name):
@@ -494,14 +703,15 @@ class BaseModelManager:
         Also returns the recommended GPU (highest sm).
         """
 
-        if torch.cuda.is_available():
+        if self.cuda_available:
             number_of_cuda_devices = torch.cuda.device_count()
             cuda_arch = []
             for i in range(number_of_cuda_devices):
+                major, minor = torch.cuda.get_device_capability(i)
                 cuda_device = {
                     "id": i,
                     "name": torch.cuda.get_device_name(i),
-                    "sm": torch.cuda.get_device_capability(i)[0] * 10 + torch.cuda.get_device_capability(i)[1],
+                    "sm": major * 10 + minor,
                 }
                 cuda_arch.append(cuda_device)
             cuda_arch = sorted(cuda_arch, key=lambda k: k["sm"], reverse=True)
@@ -516,14 +726,11 @@ class BaseModelManager:
         :param kwargs: filter based on metadata of the model reference db
         :return: list of models
         """
-        filtered_models = self.models
-        for keyword in kwargs:
-            iterating_models = filtered_models.copy()
-            filtered_models = {}
-            for model in iterating_models:
-                if iterating_models[model].get(keyword) == kwargs[keyword]:
-                    filtered_models[model] = iterating_models[model]
-        return filtered_models
+        return {
+            model: model_data
+            for model, model_data in self.models.items()
+            if all(model_data.get(keyword) == value for keyword, value in kwargs.items())
+        }
 
     def get_filtered_model_names(self, **kwargs):
         """
@@ -16,6 +16,7 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import time
+from functools import cached_property
 from pathlib import Path
 
 import torch
@@ -29,19 +30,34 @@ from nataili.util.logger import logger
 
 
 class CodeFormerModelManager(BaseModelManager):
-    def __init__(self, download_reference=True):
+    def __init__(self, download_reference=True, gfpgan: GfpganModelManager = None, esrgan: EsrganModelManager = None):
+        """
+        download_reference: bool. If True, the model reference is downloaded instead of using the local copy.
+        gfpgan: GfpganModelManager. Manager used for face restoration. If not set, one is created on first use.
+        esrgan: EsrganModelManager. Manager used for background upscaling. If not set, one is created on first use.
+        """
         super().__init__()
         self.download_reference = download_reference
         self.path = f"{get_cache_directory()}/codeformer"
         self.models_db_name = "codeformer"
-        self.gfpgan = GfpganModelManager()
-        self.esrgan = EsrganModelManager()
+        if gfpgan is not None:
+            self.gfpgan = gfpgan
+        if esrgan is not None:
+            self.esrgan = esrgan
         self.models_path = self.pkg / f"{self.models_db_name}.json"
         self.remote_db = (
             f"https://raw.githubusercontent.com/db0/AI-Horde-image-model-reference/main/{self.models_db_name}.json"
         )
         self.init()
 
+    @cached_property
+    def gfpgan(self):
+        return GfpganModelManager()
+
+    @cached_property
+    def esrgan(self):
+        return EsrganModelManager()
+
     def load(
         self,
         model_name: str,
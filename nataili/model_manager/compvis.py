@@ -145,7 +145,7 @@ class CompVisModelManager(BaseModelManager):
                 },
                 "available": True,
             }
-            self.available_models.append(model_name)
+            self.available_models.add(model_name)
 
     def load_available_models_from_custom(self, replace=False):
         # ckpt files and matching config yaml files
@@ -93,7 +93,8 @@ class ModelManager:
         if codeformer:
             from nataili.model_manager.codeformer import CodeFormerModelManager
 
-            self.codeformer = CodeFormerModelManager()
+            # Reuse the managers created above instead of constructing (and initialising) them again
+            self.codeformer = CodeFormerModelManager(gfpgan=self.gfpgan, esrgan=self.esrgan)
         else:
             self.codeformer = None
         if controlnet:
@@ -104,7 +105,7 @@ class ModelManager:
             self.controlnet = None
         self.cuda_available = torch.cuda.is_available()
         self.models = {}
-        self.available_models = []
+        self.available_models = set()
         self.loaded_models = {}
         self.init()
 
@@ -128,11 +129,11 @@ class ModelManager:
             self.controlnet,
         ]
         # reset available models
-        self.available_models = []
+        self.available_models = set()
         for model_type in model_types:
             if model_type is not None:
                 self.models.update(model_type.models)
-                self.available_models.extend(model_type.available_models)
+                self.available_models.update(model_type.available_models)
 
     def reload_database(self):
         """
@@ -154,12 +155,12 @@ class ModelManager:
             self.codeformer,
             self.controlnet,
         ]
-        self.available_models = []  # reset available models
+        self.available_models = set()  # reset available models
         for model_type in model_types:
             if model_type is not None:
                 model_type.init()
                 self.models.update(model_type.models)
-                self.available_models.extend(model_type.available_models)
+                self.available_models.update(model_type.available_models)
 
     def download_model(self, model_name):
         if self.aitemplate is not None and model_name in self.aitemplate.models:
@@ -318,9 +319,9 @@ class ModelManager:
 
     def get_available_models(self):
         """
-        Returns the available models
+        Returns the available models, in the order of the model references
         """
-        return self.available_models
+        return [model for model in self.models if model in self.available_models]
 
     def load(
         self,
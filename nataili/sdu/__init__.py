@@ -1 +1,9 @@
-from .sdu import StableDiffusionUpscaler
+from nataili.util.lazy import lazy_getattr
+
+_LAZY = {
+    "StableDiffusionUpscaler": ".sdu",
+}
+
+__all__ = list(_LAZY)
+
+__getattr__ = lazy_getattr(__name__, _LAZY)
@@ -1 +1,9 @@
-from .compvis import CompVis
+from nataili.util.lazy import lazy_getattr
+
+_LAZY = {
+    "CompVis": ".compvis",
+}
+
+__all__ = list(_LAZY)
+
+__getattr__ = lazy_getattr(__name__, _LAZY)
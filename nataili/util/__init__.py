@@ -1,20 +1,24 @@
-# from .blip import blip_decoder
-# from .cache import torch_gc
-# from .cast import autocast_cpu, autocast_cuda
-# from .check_prompt_length import check_prompt_length
-# from .codeformer.codeformer import CodeFormer
-# from .codeformer.face_restoration_helper import FaceRestoreHelper
-# from .create_random_tensors import create_random_tensors
-# from .get_next_sequence_number import get_next_sequence_number
-# from .gfpgan.utils import GFPGANer
-# from .image_grid import image_grid
-# from .img2img import find_noise_for_image, get_matched_noise, process_init_mask, resize_image
-# from .load_learned_embed_in_clip import load_learned_embed_in_clip
-# from .load_list import load_list
-# from .logger import logger, set_logger_verbosity
-# from .normalized import normalized
-# from .postprocessor import PostProcessor
-# from .process_prompt_tokens import process_prompt_tokens
-# from .save_sample import save_sample
-# from .seed_to_int import seed_to_int
-# from .switch import Switch
+from .lazy import lazy_getattr
+from .switch import Switch
+
+_LAZY = {
+    "blip_decoder": ".blip",
+    "torch_gc": ".cache",
+    "autocast_cpu": ".cast",
+    "autocast_cuda": ".cast",
+    "CodeFormer": ".codeformer.codeformer",
+    "FaceRestoreHelper": ".codeformer.face_restoration_helper",
+    "GFPGANer": ".gfpgan.utils",
+    "find_noise_for_image": ".img2img",
+    "get_matched_noise": ".img2img",
+    "process_init_mask": ".img2img",
+    "resize_image": ".img2img",
+    "add_learned_embeds_in_clip": ".load_learned_embed_in_clip",
+    "read_learned_embed": ".load_learned_embed_in_clip",
+    "set_logger_verbosity": ".logger",
+    "PostProcessor": ".postprocessor",
+}
+
+__all__ = ["Switch"] + list(_LAZY)
+
+__getattr__ = lazy_getattr(__name__, _LAZY)
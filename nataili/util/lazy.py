@@ -0,0 +1,38 @@
+"""
+This file is part of nataili ("Homepage" = "https://github.com/db0/nataili").
+
+Copyright 2022-2023 hlky. Copyright 2023 hlky and AI Horde Community
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import importlib
+import sys
+
+
+def lazy_getattr(module_name: str, mapping: dict):
+    """
+    :param module_name: __name__ of the package re-exporting the names
+    :param mapping: Dict of re-exported name to the relative module defining it
+    Returns a module level __getattr__ (PEP 562) importing each name from its module when it is first used,
+    so importing a package does not pull in the heavy dependencies of all its submodules.
+    Names which are the same as their submodule can not be re-exported, the submodule would shadow them.
+    """
+
+    def __getattr__(name):
+        if name in mapping:
+            value = getattr(importlib.import_module(mapping[name], module_name), name)
+            setattr(sys.modules[module_name], name, value)
+            return value
+        raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+
+    return __getattr__
@@ -20,37 +20,47 @@ import os
 import torch
 
 
-def load_learned_embed_in_clip(learned_embeds_path, text_encoder, tokenizer, token=None):
+def read_learned_embed(learned_embeds_path):
+    """
+    :param learned_embeds_path: Path of a textual inversion embedding, .pt (old format) or .bin
+    Returns the trained token and its embeds, on the CPU
+    """
     loaded_learned_embeds = torch.load(learned_embeds_path, map_location="cpu")
     # separate token and the embeds
     if learned_embeds_path.endswith(".pt"):
         # old format
-        # token = * so replace with file directory name when converting
+        # token = * so use the file name instead
         trained_token = os.path.basename(learned_embeds_path)
-        params_dict = {trained_token: torch.tensor(list(loaded_learned_embeds["string_to_param"].items())[0][1])}
-        learned_embeds_path = os.path.splitext(learned_embeds_path)[0] + ".bin"
-        torch.save(params_dict, learned_embeds_path)
-        loaded_learned_embeds = torch.load(learned_embeds_path, map_location="cpu")
-        trained_token = list(loaded_learned_embeds.keys())[0]
-        embeds = loaded_learned_embeds[trained_token]
-    elif learned_embeds_path.endswith(".bin"):
-        trained_token = list(loaded_learned_embeds.keys())[0]
+        embeds = next(iter(loaded_learned_embeds["string_to_param"].values())).detach()
+    else:
+        trained_token = next(iter(loaded_learned_embeds))
         embeds = loaded_learned_embeds[trained_token]
+    return trained_token, embeds
 
-    embeds = loaded_learned_embeds[trained_token]
-    # cast to dtype of text_encoder
-    dtype = text_encoder.get_input_embeddings().weight.dtype
-    embeds.to(dtype)
-
-    # add the token in tokenizer
-    token = token if token is not None else trained_token
 
-    tokenizer.add_tokens(token)
+def add_learned_embeds_in_clip(learned_embeds, text_encoder, tokenizer):
+    """
+    :param learned_embeds: Dict of token to embeds
+    Adds all tokens to the tokenizer and resizes the token embeddings of text_encoder once for all of them
+    Returns the list of tokens
+    """
+    # add the tokens in tokenizer
+    tokenizer.add_tokens(list(learned_embeds))
 
     # resize the token embeddings
     text_encoder.resize_token_embeddings(len(tokenizer))
 
-    # get the id for the token and assign the embeds
-    token_id = tokenizer.convert_tokens_to_ids(token)
-    text_encoder.get_input_embeddings().weight.data[token_id] = embeds
+    # get the id for each token and assign the embeds
+    weight = text_encoder.get_input_embeddings().weight
+    for token, embeds in learned_embeds.items():
+        token_id = tokenizer.convert_tokens_to_ids(token)
+        # cast to dtype and move to device of text_encoder in one copy, the file itself is always read on the CPU
+        weight.data[token_id] = embeds.to(device=weight.device, dtype=weight.dtype)
+    return list(learned_embeds)
+
+
+def load_learned_embed_in_clip(learned_embeds_path, text_encoder, tokenizer, token=None):
+    trained_token, embeds = read_learned_embed(learned_embeds_path)
+    token = token if token is not None else trained_token
+    add_learned_embeds_in_clip({token: embeds}, text_encoder, tokenizer)
     return token
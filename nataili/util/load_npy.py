@@ -0,0 +1,88 @@
+"""
+This file is part of nataili ("Homepage" = "https://github.com/db0/nataili").
+
+Copyright 2022-2023 hlky. Copyright 2023 hlky and AI Horde Community
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import io
+import mmap
+import os
+import sys
+
+import numpy as np
+
+from nataili.util.logger import logger
+
+# O_DIRECT requires the buffer, offset and length to be block aligned, page alignment covers common block sizes
+DIRECT_IO_ALIGNMENT = mmap.PAGESIZE
+DIRECT_IO_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def fast_io():
+    """
+    disabled by default
+    """
+    return os.environ.get("NATAILI_FAST_IO", "0") == "1"
+
+
+def _read_direct(filename):
+    """
+    :param filename: Path of the file to read
+    :return: Page aligned anonymous mmap holding the file contents, and the file size
+    Reads the whole file with O_DIRECT in large chunks, bypassing the page cache.
+    """
+    size = os.path.getsize(filename)
+    aligned_size = -(-size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+    buffer = mmap.mmap(-1, aligned_size)
+    view = memoryview(buffer)
+    fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+    try:
+        offset = 0
+        while offset < size:
+            read = os.preadv(fd, [view[offset : offset + DIRECT_IO_CHUNK_SIZE]], offset)
+            if read == 0:
+                break
+            offset += read
+    finally:
+        os.close(fd)
+        view.release()
+    if offset < size:
+        buffer.close()
+        raise OSError(f"Short read of {filename}: {offset} of {size} bytes")
+    return buffer, size
+
+
+def load_npy(filename):
+    """
+    :param filename: Path of the .npy file to load
+    :return: numpy array
+    The array is memory mapped copy-on-write, so pages are read from disk on demand.
+    If NATAILI_FAST_IO=1 on Linux, the file is instead read in one pass with O_DIRECT.
+    Falls back to memory mapping if the filesystem does not support O_DIRECT.
+    """
+    if fast_io() and sys.platform == "linux":
+        try:
+            buffer, size = _read_direct(filename)
+        except OSError as e:
+            logger.debug(f"O_DIRECT read of {filename} failed, falling back to mmap: {e}")
+        else:
+            header = io.BytesIO(buffer[: min(size, 65536)])
+            version = np.lib.format.read_magic(header)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+            array = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=header.tell())
+            return array.reshape(shape, order="F" if fortran_order else "C")
+    return np.load(filename, mmap_mode="c")
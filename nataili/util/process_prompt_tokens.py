@@ -17,7 +17,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
 
-from nataili.util import load_learned_embed_in_clip
+from nataili.util.load_learned_embed_in_clip import add_learned_embeds_in_clip, read_learned_embed
+
+EMBEDDING_EXTENSIONS = frozenset((".pt", ".bin"))
 
 
 def process_prompt_tokens(prompt_tokens, model, concepts_dir):
@@ -28,18 +30,26 @@ def process_prompt_tokens(prompt_tokens, model, concepts_dir):
     # tokenizer = pipe.tokenizer
     # text_encoder = pipe.text_encoder
 
-    ext = (".pt", ".bin")
-    for token_name in prompt_tokens:
+    # Concepts stay registered in the tokenizer, so they are only loaded the first time a prompt uses them.
+    # The tokenizer is only looked at once a concept is found, not every cond_stage_model has one.
+    added_tokens = None
+    # Embeds are gathered first so the token embeddings are resized once for all new concepts
+    learned_embeds = {}
+    for token_name in dict.fromkeys(prompt_tokens):
         embedding_path = os.path.join(concepts_dir, token_name)
-        if os.path.exists(embedding_path):
-            for files in os.listdir(embedding_path):
-                if files.endswith(ext):
-                    load_learned_embed_in_clip(
-                        f"{os.path.join(embedding_path, files)}",
-                        model.cond_stage_model.transformer,
-                        model.cond_stage_model.tokenizer,
-                        f"<{token_name}>",
-                    )
+        if os.path.isdir(embedding_path):
+            if added_tokens is None:
+                added_tokens = model.cond_stage_model.tokenizer.get_added_vocab()
+            if f"<{token_name}>" in added_tokens:
+                continue
+            with os.scandir(embedding_path) as entries:
+                for entry in entries:
+                    if entry.is_file() and os.path.splitext(entry.name)[1] in EMBEDDING_EXTENSIONS:
+                        learned_embeds[f"<{token_name}>"] = read_learned_embed(entry.path)[1]
         else:
             print(f"Concept {token_name} not found in {concepts_dir}")
-            return
+            break
+    if learned_embeds:
+        add_learned_embeds_in_clip(
+            learned_embeds, model.cond_stage_model.transformer, model.cond_stage_model.tokenizer
+        )